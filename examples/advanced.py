@@ -10,7 +10,6 @@ Try out this example:
 from __future__ import print_function
 import logging
 import os
-import time
 
 import tcbon
 
@@ -89,12 +88,12 @@ if __name__ == '__main__':
         # a tcbon.Process in a larger application - like a Qt application.
         advanced.start()
 
-        # Wait for KeyboardInterrupt
-        while True:
-            try:
-                time.sleep(1)
-            except KeyboardInterrupt:
-                advanced.stop()
+        # Wait until stopped - start installs a SIGINT handler that stops
+        # the Process before the KeyboardInterrupt is raised.
+        try:
+            advanced.wait()
+        except KeyboardInterrupt:
+            pass
 
     except tcbon.ProcessExists:
 
@@ -113,3 +112,9 @@ if __name__ == '__main__':
 
         response = advanced.send('decrement', {'value': 1})
         print("advanced.send('decrement', {'value': 1}) -> %s" % response)
+
+        # Send several requests at once
+        with advanced.buffered_send() as batch:
+            batch.send('increment')
+            batch.send('decrement', {'value': 2})
+        print("advanced.buffered_send() -> %s" % batch.responses)
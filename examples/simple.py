@@ -18,7 +18,7 @@ def on_ack(event):
 
 # Create a Process
 simple = tcbon.Process('simple')
-simple.register_event_handler('ack', on_ack)
+simple.register_event_handler('ack', on_ack, cacheable=True)
 
 
 if __name__ == '__main__':
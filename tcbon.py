@@ -16,30 +16,397 @@ __license__ = 'MIT'
 
 # Standard library imports
 import atexit
+import ctypes
+import errno
+import json
 import logging
 import os
+import re
 import traceback
 import signal
 import socket
-import subprocess
 import sys
-import time
 import threading
+from contextlib import contextmanager
 from functools import partial
 
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+# Raised by http.client when a kept-alive connection was closed by the server
+_RemoteDisconnected = getattr(
+    httplib,
+    'RemoteDisconnected',
+    httplib.BadStatusLine,
+)
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 # Third party imports
 import requests
+from requests.adapters import HTTPAdapter
 from appdirs import user_data_dir
-from flask import Flask, request, jsonify
+from flask import (
+    Flask,
+    Request,
+    Response,
+    current_app,
+    has_app_context,
+    has_request_context,
+    request,
+)
+from flask import json as flask_json
+from waitress import create_server
+from waitress.channel import HTTPChannel
+from waitress.trigger import trigger
 from werkzeug.exceptions import HTTPException
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+
+def _json_default(obj):
+    '''Serialize objects json does not support like flask.jsonify does, with
+    the app's json_encoder when there is one.'''
+
+    if has_app_context():
+        encoder = current_app.json_encoder
+    else:
+        encoder = flask_json.JSONEncoder
+    return encoder().default(obj)
+
+
+def _dumps(obj):
+    '''Serialize obj to json bytes, using orjson when it's available.'''
+
+    if orjson:
+        try:
+            return orjson.dumps(
+                obj,
+                default=_json_default,
+                option=(
+                    orjson.OPT_NON_STR_KEYS
+                    | orjson.OPT_PASSTHROUGH_DATETIME
+                ),
+            )
+        except TypeError:
+            # orjson.JSONEncodeError, like integers wider than 64 bits
+            pass
+    return flask_json.dumps(obj).encode('utf-8')
+
+
+# Integers orjson may read as floats, it only supports 64 bit integers
+_wide_int = re.compile(br'\d{20}')
+
+
+def _loads(data):
+    '''Deserialize json bytes, using orjson when it's available.'''
+
+    if orjson and not _wide_int.search(data):
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def _json_keys(obj):
+    '''Convert dict keys to strings the way json does, so msgpack decodes to
+    the same shapes as json.'''
+
+    if isinstance(obj, dict):
+        return dict(
+            (_json_key(key), _json_keys(value))
+            for key, value in obj.items()
+        )
+    if isinstance(obj, (list, tuple)):
+        return [_json_keys(value) for value in obj]
+    return obj
+
+
+def _json_key(key):
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, (bool, int, float)):
+        return json.dumps(key)
+    return str(key)
+
+
+def _encode(obj, mimetype):
+    '''Serialize obj to bytes of the given mimetype. Returns the bytes and
+    their mimetype, json when obj can't be packed with msgpack.'''
+
+    if mimetype == MSGPACK:
+        try:
+            data = msgpack.packb(
+                _json_keys(obj),
+                default=_json_default,
+                use_bin_type=True,
+            )
+            return data, MSGPACK
+        except (TypeError, ValueError, OverflowError):
+            # Like integers wider than 64 bits
+            pass
+    return _dumps(obj), JSON
+
+
+def _decode(data, mimetype):
+    '''Deserialize bytes of the given mimetype.'''
+
+    if mimetype == MSGPACK:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return _loads(data)
+
+
+def _response_mimetype():
+    '''Get the mimetype to respond with, msgpack when the client accepts it
+    and msgpack is available.'''
+
+    if (
+        msgpack
+        and has_request_context()
+        and request.headers.get('Accept') == MSGPACK
+    ):
+        return MSGPACK
+    return JSON
+
+
+def _fast_json(*args, **kwargs):
+    '''Like flask.jsonify but serializes with orjson when it's available.
+
+    Responds with msgpack instead when the client accepts it.
+    '''
+
+    if args and kwargs:
+        raise TypeError('jsonify accepts args or kwargs, not both.')
+    if len(args) == 1:
+        obj = args[0]
+    else:
+        obj = args or kwargs
+    data, mimetype = _encode(obj, _response_mimetype())
+    return Response(data, mimetype=mimetype)
+
+
+# Available to routes added in Process.setup_wsgi
+jsonify = _fast_json
+
 
 def get_open_port():
     '''Get an available port to use.'''
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(('', 0))
-    return sock.getsockname()[1]
+    try:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def _pid_alive_win(pid):
+    '''Check if a process exists on windows without spawning a subprocess.'''
+
+    from ctypes import wintypes
+
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    ERROR_ACCESS_DENIED = 5
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.OpenProcess.argtypes = (
+        wintypes.DWORD,
+        wintypes.BOOL,
+        wintypes.DWORD,
+    )
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    handle = kernel32.OpenProcess(
+        PROCESS_QUERY_LIMITED_INFORMATION,
+        False,
+        int(pid),
+    )
+    if not handle:
+        # Processes of other users or elevated processes can't be opened
+        return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+
+    kernel32.CloseHandle(handle)
+    return True
+
+
+@contextmanager
+def _thread_defaults(stack_size=None, core=None):
+    '''Apply a stack size and cpu affinity to threads started in this block.
+
+    New threads inherit the cpu affinity of the thread that starts them, so
+    the calling thread is pinned to core until the block exits. Pinning is
+    only supported on Linux.
+    '''
+
+    old_stack_size = None
+    if stack_size:
+        old_stack_size = threading.stack_size(stack_size)
+
+    old_affinity = None
+    if core is not None and hasattr(os, 'sched_setaffinity'):
+        old_affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, {core})
+
+    try:
+        yield
+    finally:
+        if old_stack_size is not None:
+            threading.stack_size(old_stack_size)
+        if old_affinity is not None:
+            os.sched_setaffinity(0, old_affinity)
+
+
+def _wrap_event_handler(handler, log):
+    '''Wrap an event handler so that it always returns a response payload.'''
+
+    def dispatch(event):
+        try:
+            # Update the handler's payload in place rather than copying it
+            payload = handler(event) or {}
+            payload.setdefault('success', True)
+            return payload
+        except Exception:
+            log.exception('Event handler raise an exception...')
+            return {
+                'success': False,
+                'message': traceback.format_exc(),
+            }
+
+    dispatch.handler = handler
+    return dispatch
+
+
+def _cache_event_handler(dispatch, maxsize=128):
+    '''Memoize the serialized responses of an idempotent event handler.
+
+    Returns a function that takes an event and a mimetype and returns the
+    encoded response and its mimetype, or None when the event can't be used
+    as a cache key. Only successful responses are cached.
+    '''
+
+    cache = {}
+
+    def cached(event, mimetype=JSON):
+        try:
+            # Include types so 1, 1.0 and True are different keys
+            key = (mimetype, frozenset(
+                (name, type(value), value) for name, value in event.items()
+            ))
+        except TypeError:
+            # Unhashable values in the event
+            return None
+
+        response = cache.get(key)
+        if response is None:
+            payload = dispatch(event)
+            response = _encode(payload, mimetype)
+            if payload.get('success'):
+                if len(cache) >= maxsize:
+                    cache.clear()
+                cache[key] = response
+        return response
+
+    cached.handler = dispatch.handler
+    return cached
+
+
+def _unhandled_event(event):
+    return {
+        'success': True,
+        'message': 'Event received. no handler found for ' + event['name'],
+    }
+
+
+class _Request(Request):
+    '''Flask Request that also decodes msgpack bodies in get_json.'''
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if msgpack and self.mimetype == MSGPACK:
+            try:
+                return _decode(self.get_data(cache=cache), MSGPACK)
+            except Exception as e:
+                if silent:
+                    return None
+                return self.on_json_loading_failed(e)
+        return super(_Request, self).get_json(force, silent, cache)
+
+
+def _is_stale_conn_error(e):
+    '''Check if e was raised using a kept-alive connection that the server
+    closed before reading the request, so the request can safely be resent.'''
+
+    if isinstance(e, _RemoteDisconnected):
+        return True
+    return getattr(e, 'errno', None) in (errno.EPIPE, errno.ECONNRESET)
+
+
+class _ConnectFailed(Exception):
+    '''Raised when a connection to a wsgi server could not be opened, the
+    request was never sent.'''
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    '''HTTPConnection over a unix domain socket.'''
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class Batch(object):
+    '''Queues requests to a Process and sends them together in one request.
+
+    Use Process.buffered_send to create a Batch.
+
+    Attributes:
+        process (Process): The Process to send requests to
+        max_batch (int): Send queued requests once this many are queued
+        ops (list): Queued requests
+        responses (list): Responses to all requests sent so far
+    '''
+
+    def __init__(self, process, max_batch=128):
+        self.process = process
+        self.max_batch = max_batch
+        self.ops = []
+        self.responses = []
+
+    def send(self, route, payload=None):
+        '''Queue a post request with a json payload to the specified route.'''
+
+        self.ops.append({'route': route, 'payload': payload or {}})
+        if len(self.ops) >= self.max_batch:
+            self.flush()
+
+    def flush(self):
+        '''Send all queued requests.'''
+
+        if not self.ops:
+            return
+
+        ops, self.ops = self.ops, []
+        response = self.process.send('batch', {'ops': ops})
+        if not response.get('success'):
+            raise Error('Batch failed: %s' % response.get('message'))
+        self.responses.extend(response['responses'])
 
 
 class Error(Exception):
@@ -60,20 +427,31 @@ class Process(object):
 
     When started each Process runs a small flask server on an available port
     or the http address of your choice. Then the pid and address are written
-    to a file. When another Process with the same name is created, this file
-    can be used to check if a Process is already running and send events to
-    the Process if it is running. Events are simple dictionaries that have at
-    least one key "name".
+    to a file. Where supported the server also listens on a unix domain socket
+    next to the pid file, which local clients use instead of tcp. When another
+    Process with the same name is created, this file can be used to check if a
+    Process is already running and send events to the Process if it is
+    running. Events are simple dictionaries that have at least one key "name".
+
+    With workers > 1 the Process forks additional worker processes that share
+    the server's sockets, so event handlers can run on several cores. Workers
+    are forked after on_start and do not share memory with the Process, state
+    changed by a handler in one worker is not seen by the others. Keep workers
+    at 1 when handlers modify state, or store it in a multiprocessing.Value
+    created in on_start. on_stop only runs in the main Process. Workers stop
+    on their own when the main Process exits without stopping them.
 
     Attributes:
         log (logging.Logger): The Process object's logger
-        wsgi (flask.Flask): Flask application object
-        wsgi_thread (threading.Thread): The Thread containg the Flask app
+        app_dir (str): Directory containing the pid file and unix socket
+        pid_file (str): Full path to Process' pid file
+        sock_file (str): Full path to Process' unix domain socket
+        wsgi (flask.Flask): Flask application object, None once stopped
+        wsgi_thread (threading.Thread): The Thread running the waitress server
         wsgi_running (bool): True when the wsgi_thread is running
         event_handlers (dict): Contains all event handlers
 
     Properties:
-        pid_file (str): Full path to Process' pid file
         running (bool): True when Process is running
 
     Arguments:
@@ -81,9 +459,17 @@ class Process(object):
         address (str): Optional address like '127.0.0.1:9876
         app_dir (str): Optional directory in which to store .pid file
         debug (bool): Set logging level to DEBUG
+        timeout (float): Seconds to wait for a response from the wsgi server,
+            None waits forever
+        core (int): Optional cpu core to pin the wsgi server's threads to,
+            workers are pinned to the cores following it
+        stack_size (int): Stack size of the wsgi server's threads in bytes,
+            None uses the platform default
+        workers (int): Number of processes serving requests, requires os.fork
     '''
 
-    def __init__(self, name, address=None, app_dir=None, debug=False):
+    def __init__(self, name, address=None, app_dir=None, debug=False,
+                 timeout=None, core=None, stack_size=256 * 1024, workers=1):
         self.name = name
         app_dir = (app_dir or user_data_dir(appname=name))
         self.app_dir = app_dir.replace('\\', '/').rstrip('/')
@@ -93,11 +479,44 @@ class Process(object):
         else:
             self.address = None
         self.debug = debug
+        self.timeout = timeout
+        self.core = core
+        self.stack_size = stack_size
+        self.workers = workers
         self.log = self._logger(name, debug)
         self.wsgi = self._wsgi(name)
         self.wsgi_thread = None
         self.wsgi_running = False
         self.event_handlers = {}
+        self._event_dispatch = {}
+        self._event_cache = {}
+        self._shutdown_event = threading.Event()
+        self._handlers_installed = False
+        self._server = None
+        self._server_map = None
+        self._server_trigger = None
+        self._unix_listener = None
+        self._worker_pids = []
+
+        # Reuse connections to the wsgi server between requests
+        self._session = requests.Session()
+        self._session.mount(
+            'http://',
+            HTTPAdapter(pool_connections=4, pool_maxsize=16),
+        )
+
+        # Persistent connections to local wsgi servers
+        self._conns = {}
+        self._conns_lock = threading.Lock()
+
+        # Local wsgi servers that have responded with msgpack
+        self._msgpack_targets = set()
+
+        # ((pid_file, mtime, ino, size), pid, address) of the last pid read
+        self._pid_cache = (None, None, None)
+
+        # (expires_at, (address, pid)) of the last successful running check
+        self._running_cache = (0, None)
 
     def __str__(self):
         return '<%s>("%s")' % (self.__class__.__name__, self.name)
@@ -111,11 +530,6 @@ class Process(object):
         )
 
     def _logger(self, name, debug):
-        # Silence werkzeug
-        logging.getLogger('werkzeug').setLevel(logging.ERROR)
-        os.environ['WERKZEUG_RUN_MAIN'] = 'true'
-        os.environ['FLASK_SKIP_DOTENV'] = '1'
-
         # Internal Logger
         log = logging.getLogger(name)
         log.addHandler(logging.NullHandler())
@@ -137,13 +551,14 @@ class Process(object):
         '''Creates a Flask Application object with default routes.'''
 
         wsgi = Flask(name)
+        wsgi.request_class = _Request
 
         @wsgi.route('/')
         def index():
-            return jsonify({
+            return _fast_json({
                 'succes': True,
                 'name': self.name,
-                'pid': str(os.getpid()),
+                'pid': str(self.pid),
                 'app_dir': self.app_dir,
                 'address': self.address,
             })
@@ -152,19 +567,61 @@ class Process(object):
         def receive_event():
             event = request.get_json()
             if 'name' not in event:
-                return jsonify({
+                return _fast_json({
                     'success': False,
                     'message': 'Event missing required field "name".',
                 })
 
+            # Skip the cache when event_handlers was modified directly
+            cached = self._event_cache.get(event['name'])
+            if cached and cached.handler is self.event_handlers.get(
+                event['name']
+            ):
+                response = cached(event, _response_mimetype())
+                if response is not None:
+                    return Response(response[0], mimetype=response[1])
+
             response = self._handle_event(event)
-            return jsonify(response)
+            return _fast_json(response)
+
+        @wsgi.route('/batch', methods=['POST'])
+        def batch():
+            # Dispatch each op as if it were sent as a separate request
+            responses = []
+            for op in request.get_json().get('ops', []):
+                ctx = wsgi.test_request_context(
+                    '/' + op['route'].lstrip('/'),
+                    method='POST',
+                    json=op.get('payload') or {},
+                )
+                with ctx:
+                    try:
+                        response = wsgi.full_dispatch_request()
+                        responses.append(_loads(response.get_data()))
+                    except Exception:
+                        self.log.exception('Batched request raised...')
+                        responses.append({
+                            'success': False,
+                            'message': traceback.format_exc(),
+                        })
+
+            return _fast_json({
+                'success': True,
+                'responses': responses,
+            })
 
         @wsgi.route('/stop', methods=['POST'])
         def stop():
-            server_shutdown = request.environ['werkzeug.server.shutdown']
-            server_shutdown()
-            return jsonify({
+            # Close the server from another thread, waitress waits for this
+            # request to finish before it closes.
+            def do_stop():
+                self._stop_workers()
+                self._close_server()
+
+            thread = threading.Thread(target=do_stop)
+            thread.daemon = True
+            thread.start()
+            return _fast_json({
                 'success': True,
                 'message': 'Shutting down...',
             })
@@ -172,20 +629,23 @@ class Process(object):
         @wsgi.route('/restart', methods=['POST'])
         def restart():
             # TODO: This is only partially functioning from a windows terminal
+            if self._worker_pids or self.pid != os.getpid():
+                return _fast_json({
+                    'success': False,
+                    'message': 'Restart is not supported with workers.',
+                })
+
             self.log.info('Restarting %s' % repr(self))
-            server_shutdown = request.environ['werkzeug.server.shutdown']
 
-            def do_restart(server_shutdown):
+            def do_restart():
+                self._close_server()
                 os.execl(sys.executable, sys.executable, *sys.argv)
 
-            thread = threading.Thread(
-                target=do_restart,
-                args=(server_shutdown,)
-            )
+            thread = threading.Thread(target=do_restart)
+            thread.daemon = True
             thread.start()
 
-            server_shutdown()
-            return jsonify({
+            return _fast_json({
                 'success': True,
                 'message': 'Restarting...',
             })
@@ -193,8 +653,8 @@ class Process(object):
         @wsgi.errorhandler(HTTPException)
         def handle_error(e):
             self.log.error(str(e))
-            response = jsonify({'success': False, 'message': str(e)})
-            response.status_code = e.status_code
+            response = _fast_json({'success': False, 'message': str(e)})
+            response.status_code = e.code
             return response
 
         self.setup_wsgi(wsgi)
@@ -202,34 +662,44 @@ class Process(object):
 
     def _handle_event(self, event):
         '''Handle one event. Dispatches events to registered handlers.'''
-        handler = self.event_handlers.get(event['name'], None)
-        if handler:
-            try:
-                payload = handler(event)
-                return dict(
-                    success=True,
-                    **payload
-                )
-            except Exception:
-                self.log.exception('Event handler raise an exception...')
-                exc = traceback.format_exc()
-                return {
-                    'success': False,
-                    'message': exc,
-                }
 
-        return {
-            'success': True,
-            'message': 'Event received. no handler found for ' + event['name'],
-        }
+        name = event['name']
+        handler = self.event_handlers.get(name)
+        if handler is None:
+            return _unhandled_event(event)
+
+        dispatch = self._event_dispatch.get(name)
+        if dispatch is None or dispatch.handler is not handler:
+            # Assigned to event_handlers directly, wrap it once
+            dispatch = _wrap_event_handler(handler, self.log)
+            self._event_dispatch[name] = dispatch
+        return dispatch(event)
 
     def _read_pid_file(self):
-        '''Read the proc's pid file.'''
+        '''Read the proc's pid file. Cached until the pid file changes.'''
+
+        # The pid file is replaced on write, so a new inode also catches
+        # rewrites within the mtime resolution of coarse filesystems.
+        stat = os.stat(self.pid_file)
+        key = (
+            self.pid_file,
+            getattr(stat, 'st_mtime_ns', stat.st_mtime),
+            stat.st_ino,
+            stat.st_size,
+        )
+        if key == self._pid_cache[0]:
+            return self._pid_cache[1:]
 
         self.log.debug('Reading ' + self.pid_file)
-        with open(self.pid_file, 'r') as f:
-            pid, address = f.readlines()
+        fd = os.open(self.pid_file, os.O_RDONLY)
+        try:
+            data = os.read(fd, 256)
+        finally:
+            os.close(fd)
 
+        pid, address = data.decode('utf-8').split('\n', 1)
+        pid, address = pid.strip(), address.strip()
+        self._pid_cache = (key, pid, address)
         return pid, address
 
     def _write_pid_file(self, pid, address):
@@ -239,13 +709,24 @@ class Process(object):
             self.log.debug('Creating ' + self.app_dir)
             os.makedirs(self.app_dir)
 
+        # Write to a temporary file and swap it in, so running never reads a
+        # partially written pid file.
         self.log.debug('Writing ' + self.pid_file)
-        with open(self.pid_file, 'w') as f:
-            f.write(str(pid) + '\n' + self.address)
+        tmp_file = self.pid_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(str(pid) + '\n' + address)
+        getattr(os, 'replace', os.rename)(tmp_file, self.pid_file)
 
     @property
-    def pid_file(self):
-        return self.app_dir + '/.pid'
+    def app_dir(self):
+        return self._app_dir
+
+    @app_dir.setter
+    def app_dir(self, value):
+        # Keep paths derived from app_dir up to date
+        self._app_dir = value
+        self.pid_file = value + '/.pid'
+        self.sock_file = value + '/.sock'
 
     @property
     def running(self):
@@ -254,17 +735,24 @@ class Process(object):
         if self.wsgi_running:
             return True
 
+        if self._running_cache_hit():
+            return True
+
         if self.address:
             try:
-                response = requests.get(self.address)
-                json = response.json()
-                self.name = json['name']
-                self.pid = json['pid']
-                self.address = json['address']
-                self.app_dir = json['app_dir']
+                data = self._request('GET', '/')
+                self.name = data['name']
+                self.pid = data['pid']
+                self.address = data['address']
+                self.app_dir = data['app_dir']
+                self._cache_running()
                 return True
             except requests.ConnectionError:
+                self._running_cache = (0, None)
                 self.log.debug('Process had incorrect address.')
+            except requests.Timeout:
+                self.log.debug('Process is busy.')
+                return True
 
         if not os.path.exists(self.pid_file):
             self.log.debug('Process is not running. No .pid file found.')
@@ -281,19 +769,12 @@ class Process(object):
 
         # Check the pid first
         if sys.platform == 'win32':
-            p = subprocess.Popen(
-                'powershell Get-Process -Id ' + str(pid),
-                shell=True,
-                stderr=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-            )
-            if p.wait() == 1:
+            if not _pid_alive_win(pid):
                 self.log.debug('Process %s not found.' % pid)
                 return False
         else:
             try:
-                os.kill(pid, 0)
+                os.kill(int(pid), 0)
             except OSError:
                 self.log.debug('Process %s not found.' % pid)
                 return False
@@ -302,14 +783,31 @@ class Process(object):
         self.log.debug('Checking ' + address)
 
         # Now check that the flask app is alive
-        response = requests.get(address)
-        if not response:
+        try:
+            self._request('GET', '/')
+        except requests.ConnectionError:
             self.log.debug('Got no response from wsgi server.')
             return False
+        except requests.Timeout:
+            # Accepted our request but is busy handling others
+            self.log.debug('WSGI server is busy.')
+            return True
 
         self.log.debug('WSGI server is running, Process is accepting events.')
+        self._cache_running()
         return True
 
+    def _running_cache_hit(self):
+        '''Check if the last successful running check has not expired.'''
+
+        expires_at, key = self._running_cache
+        return key == (self.address, self.pid) and monotonic() < expires_at
+
+    def _cache_running(self, ttl=0.5):
+        '''Skip the running check for the next ttl seconds.'''
+
+        self._running_cache = (monotonic() + ttl, (self.address, self.pid))
+
     def run_forever(self):
         '''Convenient method to run this Process forever. Gracefully exits
         on KeyboardInterrupt.
@@ -321,12 +819,29 @@ class Process(object):
 
         self.start()
 
-        while True:
-            try:
-                time.sleep(1)
-            except KeyboardInterrupt:
+        try:
+            self.wait()
+        except KeyboardInterrupt:
+            # The SIGINT handler installed by start may have stopped us
+            if self.wsgi_running:
                 self.stop()
 
+    def wait(self, timeout=None):
+        '''Block until this Process is stopped, including by another Process
+        sending a stop request. Returns False if timeout expires first.'''
+
+        if timeout is not None:
+            return self._shutdown_event.wait(timeout)
+
+        # An untimed wait can not be interrupted by Ctrl+C on windows or
+        # python 2, wait in steps so KeyboardInterrupt is raised promptly.
+        if sys.platform == 'win32' or sys.version_info[0] < 3:
+            while not self._shutdown_event.wait(0.5):
+                pass
+            return True
+
+        return self._shutdown_event.wait()
+
     def start(self):
         '''Start the background server and write a pid file.'''
 
@@ -336,45 +851,92 @@ class Process(object):
         # Get this Appes attributes
         self.pid = os.getpid()
         if not self.address:
-            port = get_open_port()
-            self.address = 'http://127.0.0.1:' + str(port)
+            port = 0
         else:
-            port = self.address.split(':')[-1]
-
-        # Run on_start
-        self.on_start()
-
-        # Start wsgi server
-        self.wsgi_thread = threading.Thread(
-            target=self.wsgi.run,
-            kwargs={
-                'debug': False,
-                'host': '127.0.0.1',
-                'port': port,
-                'use_reloader': False,
-            }
-        )
-        self.wsgi_thread.start()
+            port = int(self.address.split(':')[-1])
+
+        # Bind the server's socket here and hand it to waitress, so no other
+        # process can take an open port before the server starts.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if sys.platform != 'win32':
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(('127.0.0.1', port))
+            if not port:
+                port = listener.getsockname()[1]
+                self.address = 'http://127.0.0.1:' + str(port)
+
+            self._unix_listener = self._bind_unix_socket()
+
+            self._shutdown_event.clear()
+
+            # Rebuild the Flask app if this Process was stopped
+            if self.wsgi is None:
+                self.wsgi = self._wsgi(self.name)
+
+            # Run on_start
+            self.on_start()
+
+            # Fork workers before this process starts any server threads
+            if self.workers > 1:
+                if hasattr(os, 'fork'):
+                    for index in range(1, self.workers):
+                        core = self._worker_core(index)
+                        pid = self._fork_worker(listener, core)
+                        self._worker_pids.append(pid)
+                else:
+                    self.log.warning(
+                        'Workers require os.fork, using 1 worker.'
+                    )
+
+            # Start wsgi server, waitress starts request threads on creation
+            with _thread_defaults(self.stack_size, self.core):
+                self._create_server(listener)
+                self.wsgi_thread = threading.Thread(target=self._serve)
+                self.wsgi_thread.start()
+        except BaseException:
+            # Release the sockets so the Process can be started again
+            self._stop_workers()
+            listener.close()
+            if self._unix_listener:
+                self._unix_listener.close()
+                if os.path.exists(self.sock_file):
+                    os.remove(self.sock_file)
+            self._unix_listener = None
+            self._server = None
+            self._server_map = None
+            self._server_trigger = None
+            raise
         self.wsgi_running = True
         self.log.info('Serving Process %s at %s' % (self.pid, self.address))
 
-        # Stop wsgi server on sigint
+        # Install handlers once, a Process may be started again after stop
+        if not self._handlers_installed:
+            self._install_handlers()
+
+        # Write pid file with address
+        self._write_pid_file(self.pid, self.address)
+
+    def _install_handlers(self):
+        '''Stop the wsgi server on SIGTERM, SIGINT and exit.'''
+
         sigterm_handler = signal.getsignal(signal.SIGTERM)
         sigint_handler = signal.getsignal(signal.SIGINT)
 
         def on_signal(old_handler, signum, frame):
-            self.stop()
-            if old_handler:
-                old_handler()
+            if self.wsgi_running:
+                self.stop()
+            if callable(old_handler):
+                old_handler(signum, frame)
+
+        def on_exit():
+            if self.wsgi_running:
+                self.stop()
 
         signal.signal(signal.SIGTERM, partial(on_signal, sigterm_handler))
         signal.signal(signal.SIGINT, partial(on_signal, sigint_handler))
-
-        # Stop wsgi server on exit
-        atexit.register(self.stop)
-
-        # Write pid file with address
-        self._write_pid_file(self.pid, self.address)
+        atexit.register(on_exit)
+        self._handlers_installed = True
 
     def stop(self):
         '''Stop the server by sending a shutdown event.'''
@@ -382,34 +944,341 @@ class Process(object):
         if not self.running:
             raise ProcessDoesNotExist('Can not find process.')
 
-        # Perform some teardown if we are the wsgi server
         if self.wsgi_running:
+            # We are the wsgi server, teardown and close it directly. A stop
+            # request could be handled by one of our workers instead.
             self.on_stop()
-
-        try:
-            response = self.send('stop')
-        except requests.ConnectionError:
-            self.log.error('Process wsgi server already shutdown.')
+            self._stop_workers()
+            if self.wsgi_thread.is_alive():
+                self._close_server()
+            response = {'success': True, 'message': 'Shutting down...'}
+        else:
+            response = None
+            try:
+                response = self.send('stop')
+            except requests.ConnectionError:
+                self.log.error('Process wsgi server already shutdown.')
 
         if self.wsgi_thread:
             self.log.debug('Waiting for wsgi_thread to finish...')
             self.wsgi_thread.join()
 
+        self._session.close()
+        self._close_conns()
+        self._running_cache = (0, None)
         self.log.debug('WSGI server successfully shut down.')
         self.wsgi_running = False
         self.wsgi_thread = None
-        self.wsgi = self._wsgi(self.name)
+        self._server = None
+        self._server_map = None
+        self._server_trigger = None
+        self._unix_listener = None
+        self.wsgi = None
+        self._shutdown_event.set()
         return response
 
+    def _bind_unix_socket(self):
+        '''Bind a unix domain socket at sock_file. Returns None where unix
+        domain sockets are not supported.'''
+
+        if not hasattr(socket, 'AF_UNIX'):
+            return
+
+        if not os.path.exists(self.app_dir):
+            os.makedirs(self.app_dir)
+
+        # Left behind by a Process that did not shut down cleanly
+        if os.path.exists(self.sock_file):
+            os.remove(self.sock_file)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.sock_file)
+        except socket.error:
+            self.log.debug('Failed to listen on ' + self.sock_file)
+            sock.close()
+            return
+
+        os.chmod(self.sock_file, 0o600)
+        return sock
+
+    def _create_server(self, listener):
+        '''Create a waitress server listening on listener and, when it was
+        bound, the unix domain socket.'''
+
+        self._server_map = {}
+        self._server_trigger = trigger(self._server_map)
+        self._server = create_server(
+            self.wsgi,
+            map=self._server_map,
+            sockets=[listener],
+            threads=4,
+        )
+
+        if self._unix_listener:
+            # Waitress won't mix inet and unix sockets in one server, so add
+            # a second server sharing the first one's socket map and threads.
+            from waitress.server import UnixWSGIServer
+            UnixWSGIServer(
+                self.wsgi,
+                map=self._server_map,
+                _sock=self._unix_listener,
+                dispatcher=self._server.task_dispatcher,
+                bind_socket=False,
+            )
+
+    def _worker_core(self, index):
+        '''Get the cpu core to pin a worker's threads to. Workers use the
+        cores following core, wrapping around to the first core.'''
+
+        if self.core is None or not hasattr(os, 'cpu_count'):
+            return self.core
+        return (self.core + index) % (os.cpu_count() or 1)
+
+    def _fork_worker(self, listener, core=None):
+        '''Fork a worker process serving requests on listener.
+
+        Returns the worker's pid in this process, the worker never returns.
+        '''
+
+        parent_pid = os.getpid()
+        pid = os.fork()
+        if pid:
+            return pid
+
+        # The main Process stops workers with SIGTERM. A worker that handles
+        # a stop request asks the main Process to stop the rest.
+        stopped = threading.Event()
+
+        def stop_worker():
+            if not stopped.is_set():
+                stopped.set()
+                self._close_server()
+
+        def on_sigterm(signum, frame):
+            threading.Thread(target=stop_worker).start()
+
+        def watch_parent():
+            # Stop when orphaned, the main Process can no longer stop us
+            while not stopped.wait(1):
+                if os.getppid() != parent_pid:
+                    self.log.warning('Main Process exited, stopping worker.')
+                    stop_worker()
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        try:
+            with _thread_defaults(self.stack_size, core):
+                self._create_server(listener)
+            watcher = threading.Thread(target=watch_parent)
+            watcher.daemon = True
+            watcher.start()
+            self._server.run()
+            # Our parent pid changes when orphaned, never signal its adopter
+            if not stopped.is_set() and os.getppid() == parent_pid:
+                os.kill(parent_pid, signal.SIGTERM)
+        except Exception:
+            self.log.exception('Worker %s failed.' % os.getpid())
+        finally:
+            os._exit(0)
+
+    def _stop_workers(self):
+        '''Stop all worker processes and wait for them to exit.'''
+
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        for pid in self._worker_pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        self._worker_pids = []
+
+    def _serve(self):
+        '''Run the wsgi server until it is closed.'''
+
+        self._server.run()
+
+        if self._unix_listener and os.path.exists(self.sock_file):
+            os.remove(self.sock_file)
+
+        self._shutdown_event.set()
+
+    def _close_server(self):
+        '''Close the wsgi server after in-flight requests have finished.
+
+        Must not be called from one of the server's own request threads.
+        '''
+
+        # Wait for running requests to finish
+        self._server.task_dispatcher.shutdown()
+
+        def close_all():
+            for channel in list(self._server_map.values()):
+                if not isinstance(channel, HTTPChannel):
+                    channel.close()
+                elif channel.total_outbufs_len:
+                    channel.close_when_flushed = True
+                else:
+                    channel.handle_close()
+
+        # Close sockets from the server's own thread, responses that have
+        # not yet been sent are flushed before their channel is closed.
+        self._server_trigger.pull_trigger(close_all)
+
+    def _request(self, method, route, payload=None):
+        '''Send a request to the wsgi server and return the decoded json.
+
+        Local Processes are reached over a persistent connection to their
+        unix domain socket when it is available, falling back to tcp. Remote
+        Processes are reached through the pooled requests session.
+        '''
+
+        path = '/' + route.lstrip('/')
+
+        is_local = self.address.startswith(
+            ('http://127.0.0.1', 'http://localhost')
+        )
+        if not is_local:
+            body = None
+            headers = {}
+            if payload is not None:
+                body = _dumps(payload)
+                headers['Content-Type'] = JSON
+
+            try:
+                response = self._session.request(
+                    method,
+                    self.address + path,
+                    data=body,
+                    headers=headers,
+                    timeout=self.timeout,
+                )
+            except requests.ConnectionError:
+                self._running_cache = (0, None)
+                raise
+            return _loads(response.content)
+
+        if os.path.exists(self.sock_file):
+            try:
+                return self._conn_request(
+                    self.sock_file,
+                    method,
+                    path,
+                    payload,
+                )
+            except _ConnectFailed:
+                # Only fall back to tcp when the request was never sent,
+                # handlers must not run twice.
+                self.log.debug('Failed to connect to ' + self.sock_file)
+            except socket.timeout as e:
+                # The server is busy, not gone
+                raise requests.Timeout(e)
+            except (socket.error, httplib.HTTPException) as e:
+                self._running_cache = (0, None)
+                raise requests.ConnectionError(e)
+
+        try:
+            return self._conn_request(
+                self.address,
+                method,
+                path,
+                payload,
+            )
+        except _ConnectFailed as e:
+            # Raise the same error as remote requests
+            self._running_cache = (0, None)
+            raise requests.ConnectionError(e.args[0])
+        except socket.timeout as e:
+            raise requests.Timeout(e)
+        except (socket.error, httplib.HTTPException) as e:
+            self._running_cache = (0, None)
+            raise requests.ConnectionError(e)
+
+    def _conn_request(self, target, method, path, payload=None):
+        '''Send a request over a persistent connection to target, either an
+        http address or the path to a unix domain socket.
+
+        Responses are requested as msgpack when it is available. Once target
+        has responded with msgpack, payloads are sent as msgpack too.
+
+        A request is only resent when a kept-alive connection turns out to
+        be closed before the server read it. Raises _ConnectFailed when a
+        new connection can not be opened.
+        '''
+
+        with self._conns_lock:
+            for _ in range(2):
+                headers = {}
+                if msgpack:
+                    headers['Accept'] = MSGPACK
+
+                body = None
+                if payload is not None:
+                    if target in self._msgpack_targets:
+                        mimetype = MSGPACK
+                    else:
+                        mimetype = JSON
+                    body, headers['Content-Type'] = _encode(payload, mimetype)
+
+                conn = self._conns.get(target)
+                reused = conn is not None
+                if not reused:
+                    if target.startswith('http://'):
+                        conn = httplib.HTTPConnection(
+                            target[len('http://'):],
+                            timeout=self.timeout,
+                        )
+                    else:
+                        conn = UnixHTTPConnection(target, timeout=self.timeout)
+
+                    try:
+                        conn.connect()
+                    except socket.error as e:
+                        conn.close()
+                        self._msgpack_targets.discard(target)
+                        raise _ConnectFailed(e)
+                    self._conns[target] = conn
+
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (socket.error, httplib.HTTPException) as e:
+                    conn.close()
+                    self._conns.pop(target, None)
+                    self._msgpack_targets.discard(target)
+                    # The server may have closed an idle connection, never
+                    # resend after a timeout, the handler may be running.
+                    if reused and _is_stale_conn_error(e):
+                        continue
+                    raise
+
+                mimetype = response.getheader('Content-Type', JSON)
+                mimetype = mimetype.split(';')[0].strip()
+                if mimetype == MSGPACK:
+                    self._msgpack_targets.add(target)
+                return _decode(data, mimetype)
+
+    def _close_conns(self):
+        '''Close all persistent connections to wsgi servers.'''
+
+        with self._conns_lock:
+            for conn in self._conns.values():
+                conn.close()
+            self._conns.clear()
+            self._msgpack_targets.clear()
+
     def get(self, route='/'):
         '''Sends a get request to the Process' wsgi server.'''
 
-        if not self.running:
-            raise ProcessDoesNotExist('Can not find process.')
-
-        uri = self.address + '/' + route.lstrip('/')
-        response = requests.get(uri)
-        return response.json()
+        return self._checked_request('GET', route)
 
     def send(self, route, payload=None):
         '''Sends a post request with a json payload to the specified route.
@@ -420,12 +1289,43 @@ class Process(object):
             >>> p.send('event', {'name': 'ack'})
         '''
 
+        return self._checked_request('POST', route, payload or {})
+
+    def _checked_request(self, method, route, payload=None):
+        '''Send a request to a running Process. Raises ProcessDoesNotExist
+        when it is not running.'''
+
+        cached = self._running_cache_hit()
         if not self.running:
             raise ProcessDoesNotExist('Can not find process.')
 
-        uri = self.address + '/' + route.lstrip('/')
-        response = requests.post(uri, json=payload or {})
-        return response.json()
+        try:
+            return self._request(method, route, payload)
+        except requests.ConnectionError:
+            if not cached:
+                raise
+            # Stopped after running was cached
+            self._running_cache = (0, None)
+            raise ProcessDoesNotExist('Can not find process.')
+
+    @contextmanager
+    def buffered_send(self, max_batch=128):
+        '''Queue requests and send them to the wsgi server in a single
+        request. Queued requests are sent on exit or once max_batch requests
+        are queued. Responses are collected in the Batch's responses list.
+
+        Examples:
+            >>> import tcbon
+            >>> p = tcbon.Process('test')
+            >>> with p.buffered_send() as batch:
+            ...     batch.send('event', {'name': 'ack'})
+            ...     batch.send('event', {'name': 'ack'})
+            >>> batch.responses
+        '''
+
+        batch = Batch(self, max_batch)
+        yield batch
+        batch.flush()
 
     def setup_logger(self, log):
         '''Subclasses can override this method to add handlers to this
@@ -443,14 +1343,29 @@ class Process(object):
         '''Subclasses can override this method to perform teardown for the
         application. This is run prior to sending a shutdown event.'''
 
-    def register_event_handler(self, event, handler):
-        '''Specify the handler for an event.'''
+    def register_event_handler(self, event, handler, cacheable=False):
+        '''Specify the handler for an event.
+
+        Arguments:
+            event (str): Name of the event
+            handler (callable): Called with the event dict, returns a dict
+            cacheable (bool): The handler is idempotent, cache its serialized
+                responses for identical events. Defaults to False.
+        '''
 
         self.log.debug('%s will handle all %s events' % (handler, event))
         self.event_handlers[event] = handler
+        dispatch = _wrap_event_handler(handler, self.log)
+        self._event_dispatch[event] = dispatch
+        if cacheable:
+            self._event_cache[event] = _cache_event_handler(dispatch)
+        else:
+            self._event_cache.pop(event, None)
 
     def unregister_event_handler(self, event):
         '''Remove a handler from an event.'''
 
         self.log.debug('Removing handlers for %s' % event)
         self.event_handlers.pop(event, None)
+        self._event_dispatch.pop(event, None)
+        self._event_cache.pop(event, None)